@@ -1,48 +1,234 @@
 import os
-from flask import Flask, request, jsonify, send_from_directory
-from openai import OpenAI # Import the OpenAI library
+from quart import Quart, Response, jsonify, request, send_from_directory
+from quart.json.provider import JSONProvider
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, InternalServerError, RateLimitError # Import the OpenAI library (非同期版)
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential # APIのリトライのために追加
+import httpx # HTTP接続プールの設定のために追加
 from dotenv import load_dotenv
 from functools import wraps
 import re # 日本語チェックのために正規表現ライブラリをインポート
-import json # ファイルI/Oのために追加
-import uuid # ユニークIDを生成するために追加
+import orjson # レスポンスのJSONを高速にエンコードするために追加
+import secrets # 履歴IDのプロセスごとのランダムな接頭辞を生成するために追加
+import time # サーキットブレーカーの遮断時間の計測と、履歴IDの連番の初期値のために追加
+import hashlib # キャッシュキーの生成のために追加
+from itertools import count, islice # 履歴IDの連番と、キーワード数を上限+1語で数え打ち切るために追加
+from collections import OrderedDict, deque # LRUキャッシュと履歴の件数制限のために追加
+import asyncio # 非同期処理(同時実行数の制限や並行呼び出し)のために追加
+from dataclasses import dataclass # エンドポイントごとの設定を表すために追加
+from typing import Callable, Iterable, Optional
+import weakref # ストリーミング応答が破棄された際に同時実行数の枠を返すために追加
+from types import MappingProxyType # 読み取り専用の設定テーブルのために追加
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
-# Flaskアプリケーションのインスタンスを作成
+# Quartアプリケーションのインスタンスを作成
+# QuartはFlask互換の非同期(ASGI)フレームワークで、LLM呼び出しの待ち時間中も
+# 1つのイベントループで他のリクエストを並行して処理できます。
 # static_folderのデフォルトは 'static' なので、
 # このファイルと同じ階層に 'static' フォルダがあれば自動的にそこが使われます。
-app = Flask(__name__)
+app = Quart(__name__)
+
+class OrjsonProvider(JSONProvider):
+    """
+    orjsonでエンコード・デコードするJSONプロバイダー。
+    jsonify() はPythonレベルの文字列組み立てを経由せず、orjsonのバイト列をそのまま返す。
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+app.json = OrjsonProvider(app)
+# 巨大なリクエストボディは、読み込み・JSON解析の前に413エラーで拒否する
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
 
 # --- 履歴データのファイル永続化関連 ---
-HISTORY_FILE = "history.json"
+# 履歴は1行1件のJSON Lines形式で保存し、追加時はファイル末尾に1行書き足すだけにする
+# (以前はリクエストのたびに全履歴を書き直していた)
+HISTORY_FILE = "history.jsonl"
+LEGACY_HISTORY_FILE = "history.json" # 旧形式(JSON配列)。起動時に見つかれば移行する
+HISTORY_MAX = 1000 # 保持する履歴の最大件数。超えた場合は古いものから削除される
+
+# REDIS_URL が設定されている場合は、履歴をファイルではなくRedisに保存する
+# (複数ワーカーで起動しても履歴を共有でき、再起動後も保持される。redis ライブラリが必要)
+REDIS_URL = os.getenv("REDIS_URL")
+HISTORY_KEY = "history"
+redis_client = None
+if REDIS_URL:
+    import redis.asyncio as redis
+    redis_client = redis.from_url(REDIS_URL)
+    # 該当IDの履歴のお気に入り状態を、Redis上でアトミックに切り替えるLuaスクリプト
+    toggle_favorite_script = redis_client.register_script("""
+        local items = redis.call('LRANGE', KEYS[1], 0, -1)
+        for i, raw in ipairs(items) do
+            local item = cjson.decode(raw)
+            if item.id == ARGV[1] then
+                item.favorite = not item.favorite
+                redis.call('LSET', KEYS[1], i - 1, cjson.encode(item))
+                return 1
+            end
+        end
+        return 0
+    """)
+
+_history_damaged = False # 読み込めない行が履歴ファイルにあったか
 
-def load_history():
+def load_history() -> list[dict]:
     """起動時にファイルから履歴を読み込む"""
+    global _history_damaged
     if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        # 1回の read() でまとめて読み込んでから、行ごとに解析する
+        with open(HISTORY_FILE, 'rb') as f:
+            data = f.read()
+        history_data = []
+        for number, line in enumerate(data.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                history_data.append(orjson.loads(line))
+            except orjson.JSONDecodeError as e:
+                # 書き込み途中で停止した場合などの壊れた行は読み飛ばし、次の書き込みでファイルごと書き直す
+                _history_damaged = True
+                app.logger.warning(f"Skipped unreadable line {number} in {HISTORY_FILE}: {e}")
+        return history_data
+    if os.path.exists(LEGACY_HISTORY_FILE):
+        with open(LEGACY_HISTORY_FILE, 'rb') as f:
+            history_data = orjson.loads(f.read() or b'[]')
+        save_history(history_data)
+        return history_data
     return []
 
-def save_history(history_data):
-    """履歴が更新されるたびにファイルに保存する"""
-    with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(history_data, f, ensure_ascii=False, indent=4)
+def save_history(history_data: Iterable[dict]) -> None:
+    """履歴ファイル全体を書き直す(旧形式からの移行時に使う)"""
+    # orjson はUTF-8のバイト列を直接出力する(ensure_ascii=False 相当)
+    with open(HISTORY_FILE, 'wb') as f:
+        f.write(b''.join(orjson.dumps(entry) + b'\n' for entry in history_data))
+
+# グローバル変数として履歴データを保持(Redis利用時は使用しない)
+_loaded_history = [] if redis_client else load_history()
+history_log = deque(_loaded_history, maxlen=HISTORY_MAX)
+_history_lines = len(_loaded_history) # 履歴ファイルの行数(上限超過で削除済みの古い行も含む)
+del _loaded_history
+# IDから履歴を引くための索引(history_log と同じ辞書オブジェクトを指す)
+# dequeは上限超過で先頭が消えて位置がずれるため、位置ではなく履歴そのものを持つ
+history_by_id = {item.get('id'): item for item in history_log}
+
+# 履歴ファイルへの書き込みはリクエスト処理中には行わず、バックグラウンドのタスクがまとめて行う。
+# 追記は HISTORY_FLUSH_DELAY 秒待つか HISTORY_FLUSH_BATCH 件溜まった時点で、1回の書き込みにまとめる。
+# お気に入りの切り替え・全削除はユーザー操作の結果なので、待たずにすぐ書き込む。
+HISTORY_FLUSH_DELAY = 0.5
+HISTORY_FLUSH_BATCH = 10
+_history_pending = [] # 追記待ちの行
+_history_rewrite = _history_damaged # ファイル全体の書き直しが必要か(お気に入りの切り替え・全削除・壊れた行の除去時)
+_history_flush_requested = None # 書き込み予約を知らせる asyncio.Event(サーバー起動時に作成)
+_history_flush_now = None # 待ち時間を打ち切ってすぐ書き込むことを知らせる asyncio.Event
+
+def schedule_history_write(entry=None):
+    """
+    履歴ファイルへの書き込みを予約する。
+    entry を渡すとその1件の追記、省略するとファイル全体の書き直しを予約する。
+    """
+    global _history_rewrite
+    if entry is None:
+        _history_rewrite = True
+        _history_pending.clear() # 書き直しには追記待ちの分も含まれる
+    elif not _history_rewrite:
+        _history_pending.append(orjson.dumps(entry) + b'\n')
+    if _history_flush_requested is None:
+        # バックグラウンドのタスクが動いていない場合は、その場で書き込む
+        try:
+            write_history_file(*take_history_writes())
+        except Exception as e:
+            app.logger.error(f"Failed to write history file: {e}")
+            _history_rewrite = True
+    else:
+        _history_flush_requested.set()
+        if _history_rewrite or len(_history_pending) >= HISTORY_FLUSH_BATCH:
+            _history_flush_now.set()
+
+def take_history_writes() -> tuple[bool, bytes]:
+    """予約された書き込みを取り出し、(全体を書き直すか, 書き込むバイト列) を返す"""
+    global _history_rewrite, _history_lines
+    # 上限を超えて削除された古い履歴がファイルに溜まりすぎたら、保持中の分だけに圧縮する
+    if _history_rewrite or _history_lines + len(_history_pending) > 2 * HISTORY_MAX:
+        rewrite = True
+        data = b''.join(orjson.dumps(entry) + b'\n' for entry in history_log)
+        _history_lines = len(history_log)
+    else:
+        rewrite = False
+        data = b''.join(_history_pending)
+        _history_lines += len(_history_pending)
+    _history_pending.clear()
+    _history_rewrite = False
+    return rewrite, data
+
+def write_history_file(rewrite: bool, data: bytes) -> None:
+    """取り出した書き込みを履歴ファイルに反映する"""
+    if not rewrite and not data:
+        return
+    with open(HISTORY_FILE, 'wb' if rewrite else 'ab') as f:
+        f.write(data)
+
+async def history_writer():
+    """書き込み予約を待ち、まとめて履歴ファイルに書き込むバックグラウンドタスク"""
+    global _history_flush_requested, _history_rewrite
+    while True:
+        await _history_flush_requested.wait()
+        try:
+            await asyncio.wait_for(_history_flush_now.wait(), HISTORY_FLUSH_DELAY)
+        except asyncio.TimeoutError:
+            pass
+        _history_flush_requested.clear()
+        _history_flush_now.clear()
+        # 書き込むデータはイベントループ上で取り出し、ファイルI/Oだけを別スレッドで行う
+        try:
+            await asyncio.to_thread(write_history_file, *take_history_writes())
+        except Exception as e:
+            # 取り出した分は失われるため、次回はメモリ上の履歴からファイル全体を書き直す
+            app.logger.error(f"Failed to write history file: {e}")
+            _history_rewrite = True
+        if _history_stopping:
+            _history_flush_requested = None
+            return
+
+_history_stopping = False
+_history_writer_task = None
 
-# グローバル変数として履歴データを保持
-history_log = load_history()
+@app.before_serving
+async def start_history_writer():
+    global _history_flush_requested, _history_flush_now, _history_stopping, _history_writer_task
+    if redis_client:
+        return
+    _history_flush_requested = asyncio.Event()
+    _history_flush_now = asyncio.Event()
+    _history_stopping = False
+    _history_writer_task = asyncio.create_task(history_writer())
+
+@app.after_serving
+async def stop_history_writer():
+    global _history_stopping
+    if _history_writer_task is None:
+        return
+    # 終了時に、まだ書き込んでいない履歴をファイルに反映してからタスクを終える
+    _history_stopping = True
+    _history_flush_requested.set()
+    _history_flush_now.set()
+    await _history_writer_task
 
 # 開発モード時に静的ファイルのキャッシュを無効にする
+# (全レスポンスで呼ばれる after_request フックは使わず、send_file が参照する設定値で制御する。
+#  max-age=0 になり、ブラウザは毎回ETagで更新の有無を確認する)
+def disable_static_cache():
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+
 if app.debug:
-    @app.after_request
-    def add_header(response):
-        # /static/ 以下のファイルに対するリクエストの場合
-        if request.endpoint == 'static':
-            response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-            response.headers['Pragma'] = 'no-cache' # HTTP/1.0 backward compatibility
-            response.headers['Expires'] = '0' # Proxies
-        return response
+    disable_static_cache()
 
 
 # --- OpenRouter APIクライアントの設定 ---
@@ -52,134 +238,616 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 SITE_URL = os.getenv("YOUR_SITE_URL", "http://localhost:5000") # 未設定の場合のデフォルト値
 APP_NAME = os.getenv("YOUR_APP_NAME", "FlaskVueApp") # 未設定の場合のデフォルト値
 CHAT_MODEL = os.getenv("CHAT_MODEL", "google/gemma-3-27b-it:free") # 未設定の場合のデフォルトモデル
+# 機能ごとに使用するモデル(読み取り専用)。個別に未設定の場合は CHAT_MODEL を使用する
+MODELS = MappingProxyType({
+    'plot': os.getenv("PLOT_MODEL", CHAT_MODEL),
+    'name': os.getenv("NAME_MODEL", CHAT_MODEL),
+    'proofread': os.getenv("PROOFREAD_MODEL", CHAT_MODEL),
+    'thesaurus': os.getenv("THESAURUS_MODEL", CHAT_MODEL),
+})
 client = None
-# APIキーが設定されている場合のみ、OpenAIクライアントをインスタンス化
+# APIキーが設定されている場合のみ、OpenAIクライアント(非同期版)をインスタンス化
+# クライアントは起動時に一度だけ作成し、HTTP接続プール(keep-aliveしたTLS接続)を全リクエストで再利用する
 if OPENROUTER_API_KEY:
-    client = OpenAI(
+    # HTTP/2を有効にして、同時に実行する複数のAPI呼び出しを1本のTLS接続に多重化する
+    _shared_httpx = DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+    client = AsyncOpenAI(
         base_url="https://openrouter.ai/api/v1",
         api_key=OPENROUTER_API_KEY,
         default_headers={ # Recommended by OpenRouter
             "HTTP-Referer": SITE_URL,
             "X-Title": APP_NAME,
-        }
+        },
+        http_client=_shared_httpx,
+        max_retries=0, # リトライは create_completion でまとめて行う
     )
 
+# OpenRouterへ同時に送るリクエスト数の上限(超えた分は順番待ちにして429エラーの連発を防ぐ)
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "32"))
+_inflight_semaphore = asyncio.Semaphore(MAX_INFLIGHT)
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが遮断中のため、API呼び出しを行わなかったことを表す例外"""
+
+class CircuitBreaker:
+    """
+    上流サービスの障害が fail_max 回続いたら、reset_timeout 秒間は呼び出さずに即座に失敗させる。
+    遮断時間が過ぎた後は1回だけ試行(half-open)し、成功すれば元に戻り、失敗すれば再び遮断する。
+    試行の結果が出るまでの間、他の呼び出しは遮断中と同じく即座に失敗させる。
+    """
+    def __init__(self, fail_max, reset_timeout, failure_types):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failure_types = failure_types
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    async def call(self, func, *args, **kwargs):
+        trial = False
+        if self._opened_at is not None:
+            if self._trial_in_flight or time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError()
+            trial = self._trial_in_flight = True
+        try:
+            result = await func(*args, **kwargs)
+        except self.failure_types:
+            self._failures += 1
+            # 遮断後の試行(half-open)で失敗した場合は、すぐに遮断し直す
+            if self._opened_at is not None or self._failures >= self.fail_max:
+                self._opened_at = time.monotonic()
+            raise
+        finally:
+            if trial:
+                self._trial_in_flight = False
+        self._failures = 0
+        self._opened_at = None
+        return result
+
+# 接続エラー・タイムアウト・429・5xxが(リトライ後も)5回続いたら、30秒間はAPIを呼び出さずに503を返す
+_breaker = CircuitBreaker(
+    fail_max=5,
+    reset_timeout=30,
+    failure_types=(APIConnectionError, RateLimitError, InternalServerError),
+)
+
+async def create_completion(**kwargs):
+    """OpenRouterの障害が続いている間は呼び出さずに CircuitOpenError を送出する"""
+    return await _breaker.call(request_completion, **kwargs)
+
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    retry=retry_if_exception_type((RateLimitError, InternalServerError)),
+    reraise=True,
+)
+async def request_completion(**kwargs):
+    """
+    同時実行数を制限してOpenRouter APIを呼び出す。
+    429(レート制限)や5xxエラーの場合は、間隔を指数的に空けて最大4回まで試行する。
+    stream=True の場合は、呼び出し元が受信完了まで同時実行数の枠を確保しておく。
+    """
+    if kwargs.get('stream'):
+        return await client.chat.completions.create(**kwargs)
+    async with _inflight_semaphore:
+        return await client.chat.completions.create(**kwargs)
+
+def release_once(semaphore):
+    """セマフォの枠を1回だけ返す関数を作る(複数の経路から呼ばれても二重に返さない)"""
+    released = False
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            semaphore.release()
+    return release
+
+# --- 完全一致キャッシュの設定 ---
+
+# モデル・システムプロンプト・ユーザー入力が完全に一致するリクエストには、過去のAI応答をそのまま返す
+# EXACT_CACHE_SIZE=0 で無効化できる
+EXACT_CACHE_MAX = int(os.getenv("EXACT_CACHE_SIZE", "4096"))
+_exact_cache = OrderedDict()
+
+def exact_cache_key(model, system_prompt, user_prompt):
+    """完全一致キャッシュのキーを生成する"""
+    return hashlib.blake2b(
+        (model + "\x00" + system_prompt + "\x00" + user_prompt).encode(), digest_size=16
+    ).digest()
+
+def exact_cache_get(key):
+    """キャッシュ済みのAI応答を返す。見つからない場合はNoneを返す"""
+    if key in _exact_cache:
+        _exact_cache.move_to_end(key)
+        return _exact_cache[key]
+    return None
+
+def exact_cache_put(key, processed_text):
+    """AI応答をキャッシュに追加し、上限を超えた場合は最も古い応答を削除する"""
+    if EXACT_CACHE_MAX <= 0:
+        return
+    _exact_cache[key] = processed_text
+    _exact_cache.move_to_end(key)
+    if len(_exact_cache) > EXACT_CACHE_MAX:
+        _exact_cache.popitem(last=False)
+
+# --- 意味的キャッシュの設定 ---
+
+# SEMANTIC_CACHE=1 の場合のみ、類似した入力に対して過去のAI応答を再利用する
+# (faiss-cpu と sentence-transformers のインストールが必要)
+semantic_cache = None
+if os.getenv("SEMANTIC_CACHE") == "1":
+    # 重いライブラリを読み込むため、有効な場合だけインポートする
+    import semcache
+    try:
+        semantic_cache = semcache.SemanticCache(
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        )
+    except Exception as e:
+        app.logger.warning(f"SEMANTIC_CACHE is enabled but could not be initialized: {e}")
+
 # --- Refactoring: Helper Functions and Decorators ---
 
-def is_japanese(text):
+# キーワード数を数えるための正規表現(起動時に一度だけコンパイルする)
+_WORD_RE = re.compile(r'[^\s、]+') # 『、』や空白で区切ったもの
+_KEYWORD_RE = re.compile(r'[^\s、,]+') # 『、』『,』や空白で区切ったもの
+
+def count_words(text: str, pattern: re.Pattern = _WORD_RE, limit: Optional[int] = None) -> int:
+    """
+    区切り文字で区切られた語の数を数える(置換や分割による中間文字列を作らない)。
+    limit を指定した場合は、limit+1 語目が見つかった時点で数えるのをやめる。
+    """
+    matches = pattern.finditer(text)
+    if limit is not None:
+        matches = islice(matches, limit + 1)
+    return sum(1 for _ in matches)
+
+# 日本語の文字(ひらがな、カタカナ、漢字)のいずれかにマッチする正規表現
+_JP_RE = re.compile(r'[ぁ-んァ-ン一-龠]')
+
+def is_japanese(text: str) -> bool:
     """文字列に日本語（ひらがな、カタカナ、漢字）が含まれているかチェックする"""
-    # 日本語の文字、句読点、一般的な記号、英数字を許容する正規表現
-    # これにより、完全に日本語以外の文字列（例: "hello world"）をブロックする
-    return re.search(r'[ぁ-んァ-ン一-龠]', text)
+    # 日本語の文字が1文字もない文字列（例: "hello world"）をブロックする
+    return _JP_RE.search(text) is not None
 
 
+async def parse_json_body():
+    """
+    リクエストボディをorjsonで解析する。JSONとして解析できない場合はNoneを返す。
+    (cache=False で、受信したボディをリクエストオブジェクトに保持しない)
+    """
+    try:
+        return orjson.loads(await request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+
+# 入力チェックで返す定型のエラーレスポンスの本文は、起動時に一度だけJSONにエンコードしておく
+_ERR_NO_API_KEY = orjson.dumps({"error": "OpenRouter API key is not configured on the server."})
+_ERR_MISSING_TEXT = orjson.dumps({"error": "Missing 'text' in request body"})
+_ERR_EMPTY_TEXT = orjson.dumps({"error": "Input text cannot be empty"})
+_ERR_NOT_JAPANESE = orjson.dumps({"error": "日本語で入力してください。"})
+
+def fixed_error_response(body, status=400):
+    """エンコード済みのJSON本文からエラーレスポンスを作成する(Responseは毎回新しく作る)"""
+    return Response(body, status=status, mimetype='application/json')
+
 def api_endpoint(f):
     """
     APIエンドポイントの共通処理をまとめたデコレータ。
     - APIクライアントのセットアップ確認
     - リクエストがJSON形式であることの確認
     - JSONデータに'text'フィールドが存在し、空でないことの検証
+    受信した 'text' はここではコピーせず(strip() しない)、入力制限のチェック後に各エンドポイントで1回だけ strip() する。
     """
     @wraps(f)
-    def decorated_function(*args, **kwargs):
+    async def decorated_function(*args, **kwargs):
         if not client:
             app.logger.error("OpenRouter API key not configured.")
-            return jsonify({"error": "OpenRouter API key is not configured on the server."}), 500
+            return fixed_error_response(_ERR_NO_API_KEY, 500)
 
-        data = request.get_json()
-        if not data or 'text' not in data:
+        data = await parse_json_body()
+        text = data.get('text') if isinstance(data, dict) else None
+        # 文字列以外(数値やnull等)が渡された場合も、strip() で500エラーにせず400を返す
+        if not isinstance(text, str):
             app.logger.error("Request JSON is missing or does not contain 'text' field.")
-            return jsonify({"error": "Missing 'text' in request body"}), 400
+            return fixed_error_response(_ERR_MISSING_TEXT)
 
-        received_text = data.get('text', '').strip()
-        if not received_text:
+        # 空白だけの入力かどうかは、strip() でコピーを作らずに判定する
+        if not text or text.isspace():
             app.logger.error("Received text is empty or whitespace.")
-            return jsonify({"error": "Input text cannot be empty"}), 400
+            return fixed_error_response(_ERR_EMPTY_TEXT)
         
-        received_text = data['text'].strip()
-        # 日本語入力チェック
-        if not is_japanese(received_text):
-            return jsonify({"error": "日本語で入力してください。"}), 400
+        # 日本語入力チェック(前後の空白の有無で結果は変わらないので、受信したままの文字列で行う)
+        if not is_japanese(text):
+            return fixed_error_response(_ERR_NOT_JAPANESE)
          
         # 元の関数にリクエストデータを渡して実行
-        return f(data)
+        return await f(data)
     return decorated_function
 
-def call_openrouter_api(system_prompt, user_prompt, history_entry):
+# 履歴IDは「プロセスごとのランダムな接頭辞 + 連番」で作る(uuid4のように毎回乱数を読まない)。
+# 重複しないことは、プロセス(ワーカー・再起動)ごとに生成し直すランダムな接頭辞で担保する。
+# 連番は同じプロセス内で重複しないためのもので、起動時刻から始めるのはIDを時系列に並べやすくするためにすぎない。
+_HISTORY_ID_PREFIX = secrets.token_hex(4)
+_history_id_counter = count(int(time.time()))
+
+def next_history_id():
+    """新しい履歴IDを返す"""
+    return f"{_HISTORY_ID_PREFIX}{next(_history_id_counter):x}"
+
+async def add_history(history_entry, processed_text, cached=False):
+    """
+    AIの応答を履歴に追加し、ファイル(またはRedis)に保存する。
+    cached=True の場合は、キャッシュから返した応答であることを記録する。
+    """
+    entry = {
+        "id": next_history_id(), # ユニークなIDを生成
+        "user": history_entry, 
+        "ai": processed_text,
+        "favorite": False # デフォルトはお気に入りではない
+    }
+    if cached:
+        entry["cached"] = True
+    if redis_client:
+        # 追加と同時に、上限件数を超えた古い履歴を削除する
+        await (redis_client.pipeline()
+               .rpush(HISTORY_KEY, orjson.dumps(entry))
+               .ltrim(HISTORY_KEY, -HISTORY_MAX, -1)
+               .execute())
+        return
+    if len(history_log) == history_log.maxlen:
+        # 上限に達している場合、append で押し出される最も古い履歴を索引からも外す
+        history_by_id.pop(history_log[0].get('id'), None)
+    history_log.append(entry)
+    history_by_id[entry['id']] = entry
+    schedule_history_write(entry) # 履歴ファイルへの追記を予約
+
+def sse_event(text, event=None):
+    """Server-Sent Events形式の1イベント分の文字列を組み立てる"""
+    # SSEではデータ中の改行ごとに "data:" 行を分ける必要がある
+    lines = "".join(f"data: {line}\n" for line in text.split("\n"))
+    if event:
+        return f"event: {event}\n{lines}\n"
+    return f"{lines}\n"
+
+async def call_openrouter_api(system_prompt, user_prompt, history_entry, stream=False, model=CHAT_MODEL, semantic=True):
     """
     OpenRouter APIを呼び出し、レスポンスを処理する共通関数。
+    stream=True の場合は、生成されたトークンを逐次SSEでクライアントに返す。
+    semantic=False の場合は、意味的キャッシュを使わない(完全一致キャッシュのみ)。
+    """
+    if stream:
+        return await stream_openrouter_api(system_prompt, user_prompt, history_entry, model, semantic)
+
+    try:
+        processed_text = await complete(system_prompt, user_prompt, history_entry, model, semantic)
+    except Exception as e:
+        return ai_error_response(e)
+
+    if processed_text is None:
+        return jsonify({"error": "AIから有効な応答がありませんでした。"}), 500
+    return text_response(processed_text)
+
+async def complete(system_prompt, user_prompt, history_entry, model=CHAT_MODEL, semantic=True):
+    """
+    AIの応答テキストを取得して履歴に追加する。
+    有効な応答がなかった場合はNoneを返し、通信エラーの場合は例外を送出する。
+    """
+    processed_text, cached = await complete_cached(system_prompt, user_prompt, model, semantic)
+    if processed_text is not None:
+        # 正常に取得できたら履歴に追加
+        await add_history(history_entry, processed_text, cached=cached)
+    return processed_text
+
+async def complete_cached(system_prompt, user_prompt, model=CHAT_MODEL, semantic=True):
+    """
+    キャッシュを使ってAIの応答テキストを取得する(履歴には追加しない)。
+    (応答テキスト or None, キャッシュから返したか) を返し、通信エラーの場合は例外を送出する。
+    """
+    cached_text, store_cache = await lookup_cache(model, system_prompt, user_prompt, semantic)
+    if cached_text is not None:
+        return cached_text, True
+
+    processed_text = await complete_shared(model, system_prompt, user_prompt)
+    if processed_text is not None:
+        # 正常に取得できたらキャッシュに追加
+        store_cache(processed_text)
+    return processed_text, False
+
+async def lookup_cache(model, system_prompt, user_prompt, semantic=True):
     """
+    完全一致キャッシュ、意味的キャッシュの順にAIの応答を探す。
+    (キャッシュ済みの応答 or None, 新しい応答をキャッシュに保存する関数) を返す。
+    semantic=False の場合は、埋め込みの計算を含め意味的キャッシュを一切使わない。
+    """
+    # 完全に同じ入力の応答がキャッシュにあれば、APIを呼び出さずに返す
+    exact_key = exact_cache_key(model, system_prompt, user_prompt)
+    cached_text = exact_cache_get(exact_key)
+    if cached_text is not None:
+        app.logger.info("Exact cache hit.")
+        return cached_text, None
+
+    # 意味的キャッシュに類似した入力の応答があれば、APIを呼び出さずに返す
+    cache_namespace = (model, system_prompt)
+    cache_vec = None
+    use_semantic = semantic_cache is not None and semantic
+    if use_semantic:
+        try:
+            cache_vec, cached_text = await semantic_cache.lookup(cache_namespace, user_prompt)
+        except Exception as e:
+            # 埋め込みの計算などに失敗しても、キャッシュミスとしてAPI呼び出しに進む
+            app.logger.error(f"Semantic cache lookup failed: {e}")
+            use_semantic = False
+        else:
+            if cached_text is not None:
+                app.logger.info("Semantic cache hit.")
+                exact_cache_put(exact_key, cached_text)
+                return cached_text, None
+
+    def store_cache(processed_text):
+        exact_cache_put(exact_key, processed_text)
+        if use_semantic:
+            try:
+                semantic_cache.store(cache_namespace, cache_vec, processed_text)
+            except Exception as e:
+                app.logger.error(f"Semantic cache store failed: {e}")
+    return None, store_cache
+
+async def stream_openrouter_api(system_prompt, user_prompt, history_entry, model=CHAT_MODEL, semantic=True):
+    """
+    OpenRouter APIをストリーミングモードで呼び出し、SSEレスポンスを返す。
+    全文は生成完了後にまとめて履歴に追加する。
+    """
+    cached_text, store_cache = await lookup_cache(model, system_prompt, user_prompt, semantic)
+    if cached_text is not None:
+        await add_history(history_entry, cached_text, cached=True)
+        return text_response(cached_text, stream=True)
+
+    # ストリーミングでは応答ヘッダーの受信後もトークンを受け取り続けるため、
+    # 同時実行数の枠はストリームを最後まで読み終えるまで確保しておく
+    await _inflight_semaphore.acquire()
+    release_slot = release_once(_inflight_semaphore)
     try:
-        chat_completion = client.chat.completions.create(
+        completion_stream = await create_completion(
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ],
-            model=CHAT_MODEL,
+            model=model,
+            stream=True,
         )
+    except BaseException as e:
+        # クライアントの切断による CancelledError も含め、生成を始められなかった場合は枠を返す
+        release_slot()
+        if not isinstance(e, Exception):
+            raise
+        return ai_error_response(e)
 
-        if chat_completion.choices and chat_completion.choices[0].message:
-            processed_text = chat_completion.choices[0].message.content
-            # 正常に取得できたら履歴に追加
-            history_log.append({
-                "id": str(uuid.uuid4()), # ユニークなIDを生成
-                "user": history_entry, 
-                "ai": processed_text,
-                "favorite": False # デフォルトはお気に入りではない
-            })
-            save_history(history_log) # 履歴をファイルに保存
-            return jsonify({"message": "Success", "processed_text": processed_text})
-        else:
-            return jsonify({"error": "AIから有効な応答がありませんでした。"}), 500
+    async def generate():
+        try:
+            chunks = []
+            try:
+                async for chunk in completion_stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content or ''
+                    if delta:
+                        chunks.append(delta)
+                        yield sse_event(delta)
+            except Exception as e:
+                app.logger.error(f"OpenRouter API stream failed: {e}")
+                yield sse_event("AIサービスとの通信中にエラーが発生しました。", event="error")
+                return
+        finally:
+            # クライアントが途中で切断した場合も、上流のHTTPストリームをすぐに閉じる
+            try:
+                await completion_stream.close()
+            finally:
+                release_slot()
 
-    except Exception as e:
-        app.logger.error(f"OpenRouter API call failed: {e}")
-        return jsonify({"error": "AIサービスとの通信中にエラーが発生しました。"}), 500
+        if not chunks:
+            yield sse_event("AIから有効な応答がありませんでした。", event="error")
+            return
+        # 正常に最後まで受信できたら履歴とキャッシュに追加
+        processed_text = ''.join(chunks)
+        await add_history(history_entry, processed_text)
+        store_cache(processed_text)
+        yield sse_event("", event="done")
+
+    events = generate()
+    # 送信が始まる前にクライアントが切断し、generate() が一度も実行されない場合も枠を返す
+    weakref.finalize(events, release_slot)
+    return sse_response(events)
+
+def ai_error_response(error):
+    """API呼び出しで発生した例外を、エラーレスポンスに変換する"""
+    if isinstance(error, CircuitOpenError):
+        app.logger.warning("OpenRouter API circuit is open; request rejected.")
+        return jsonify({"error": "AIサービスが一時的に利用できません。"}), 503
+    app.logger.error(f"OpenRouter API call failed: {error}")
+    return jsonify({"error": "AIサービスとの通信中にエラーが発生しました。"}), 500
+
+def sse_response(events):
+    """SSEイベントを逐次送信するレスポンスを作成する"""
+    response = Response(events, mimetype="text/event-stream")
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx等のプロキシでバッファリングさせない
+    return response
+
+def text_response(processed_text, stream=False):
+    """生成済みのAI応答テキストを、JSONまたはSSEのレスポンスとして返す"""
+    if not stream:
+        return jsonify({"message": "Success", "processed_text": processed_text})
+
+    async def generate():
+        yield sse_event(processed_text)
+        yield sse_event("", event="done")
+    return sse_response(generate())
+
+# --- 同一リクエストの重複排除(single-flight) ---
+
+# 実行中のAPI呼び出し。同じプロンプトのリクエストが届いた場合は、新たに呼び出さずにこの結果を待つ
+_inflight_requests = {}
+
+async def complete_shared(model, system_prompt, user_prompt):
+    """
+    AIの応答テキストを返す(有効な応答がなかった場合はNone)。
+    同じプロンプトのAPI呼び出しが実行中であれば、その結果を共有する。
+    """
+    key = (model, system_prompt, user_prompt)
+    task = _inflight_requests.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch_completion(model, system_prompt, user_prompt))
+        _inflight_requests[key] = task
+        task.add_done_callback(lambda _: _inflight_requests.pop(key, None))
+    else:
+        app.logger.info("Joined an in-flight request for the same prompt.")
+    # 待っているクライアントの1つが切断しても、共有しているAPI呼び出し自体はキャンセルしない
+    return await asyncio.shield(task)
+
+async def fetch_completion(model, system_prompt, user_prompt):
+    """OpenRouter APIを1回呼び出し、応答テキストを返す"""
+    chat_completion = await create_completion(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        model=model,
+    )
+    if chat_completion.choices and chat_completion.choices[0].message:
+        return chat_completion.choices[0].message.content
+    return None
+
+# リクエストボディが MAX_CONTENT_LENGTH を超えた場合も、他のAPIエラーと同じくJSONで返す
+@app.errorhandler(413)
+async def request_too_large(error):
+    app.logger.error("Request body is too large.")
+    return jsonify({"error": "リクエストのサイズが大きすぎます。"}), 413
 
 # --- ページ表示用のルート定義 ---
 
-@app.route('/')
-def home():
-    app.logger.info("Route '/' called.")
-    return send_from_directory(app.static_folder, 'home.html')
-
-# URL:/plot に対して、プロット生成画面(index.html)を表示
-@app.route('/plot')
-def plot_page():
-    app.logger.info("Route '/plot' called.")
-    return send_from_directory(app.static_folder, 'index.html')
-
-# URL:/history に対して、履歴画面(history.html)を表示
-@app.route('/history')
-def history_page():
-    app.logger.info("Route '/history' called.")
-    return send_from_directory(app.static_folder, 'history.html')
-
-# URL:/profread に対して、文章を豊かにする画面(profread.html)を表示
-@app.route('/proofread')
-def proofread_page():
-    app.logger.info("Route '/proofread' called.")
-    return send_from_directory(app.static_folder, 'proofread.html')
+# URLのパスと、表示するHTMLファイルの対応表(ここにないパスは404を返す)
+PAGES = {
+    '': 'home.html', # URL:/ に対して、ホーム画面(home.html)を表示
+    'plot': 'index.html', # URL:/plot に対して、プロット生成画面(index.html)を表示
+    'history': 'history.html', # URL:/history に対して、履歴画面(history.html)を表示
+    'proofread': 'proofread.html', # URL:/proofread に対して、文章を豊かにする画面(proofread.html)を表示
+}
+PAGE_CACHE_SECONDS = 3600 # ブラウザにHTMLをキャッシュさせる秒数(開発モードでは0)
+_page_cache = {} # ファイル名 -> (HTMLのバイト列, ETag)。開発モード以外で使う
+
+def load_page(file_name):
+    """HTMLファイルを読み込み、(内容, ETag) をメモリにキャッシュする"""
+    cached = _page_cache.get(file_name)
+    if cached is None:
+        with open(os.path.join(app.static_folder, file_name), 'rb') as f:
+            data = f.read()
+        cached = _page_cache[file_name] = (data, hashlib.blake2b(data, digest_size=16).hexdigest())
+    return cached
+
+async def show_page(page):
+    app.logger.info(f"Route '/{page}' called.")
+    file_name = PAGES[page]
+    if app.debug:
+        # 開発モードではHTMLの編集をすぐ反映させるため、毎回ファイルから送る
+        return await send_from_directory(app.static_folder, file_name, conditional=True, cache_timeout=0)
+    # 本番ではメモリ上の内容を返し、ETagが一致すれば本文なしの304を返す
+    data, etag = load_page(file_name)
+    response = Response(data, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = PAGE_CACHE_SECONDS
+    return await response.make_conditional(request)
+
+# PAGES のパスだけを個別に登録する(任意の1階層のパスを受け取るルートにすると、
+# GETに対応していないAPIのパスにGETした場合も405ではなく404になってしまうため)
+for page_path in PAGES:
+    app.add_url_rule('/' + page_path, view_func=show_page, defaults={'page': page_path})
+
+# --- AIに渡すシステムプロンプトの定義 ---
+
+# 入力を埋め込むプロンプトは、埋め込み位置の前後(PRE/POST)に分けて起動時に一度だけ作成し、
+# リクエストごとには連結するだけにする
+_JP_NAME_PRE, _JP_NAME_POST = (
+    "あなたはプロの作家です。指定された漢字「",
+    "」をフルネームのどこかに含んだ、日本のキャラクター名を5つ提案してください。\n\n# 制約条件:\n- 提案は箇条書き（-）で記述してください。\n- それぞれの名前の横に、その名前が持つ雰囲気や由来を20字程度で簡潔に添えてください。",
+)
+_FOREIGN_NAME_PRE, _FOREIGN_NAME_POST = (
+    "あなたはプロの作家です。指定されたキーワード「",
+    "」のイメージに合う、外国風のキャラクター名をカタカナで5つ提案してください。フルネームでもファーストネームのみでも構いません。\n\n# 制約条件:\n- 提案は箇条書き（-）で記述してください。\n- それぞれの名前の横に、その名前が持つ雰囲気や由来を20字程度で簡潔に添えてください。",
+)
+_THESAURUS_PRE, _THESAURUS_POST = (
+    "あなたは語彙の専門家です。ユーザーから提供されたキーワード「",
+    "」について、類語や言い換え表現を3つ提案し、それぞれの違いが明確にわかるように解説してください。\n\n# 出力形式:\n- 提案する語彙ごとに見出しを付けてください。\n- それぞれの語彙について、「ニュアンス」と「使用例」を具体的に説明してください。\n- 全体を300字程度にまとめてください。\n- 類語や言い換え表現は日本語で提案してください。",
+)
+_PROOFREAD_PROMPT = "あなたはプロの小説家です。以下のユーザーが入力した短い文章を、情景が目に浮かぶような、豊かで具体的な小説の描写に書き換えてください。\n\n# 指示:\n- 変換後の文章のみを出力し、解説や前置きは一切含めないでください。\n- 300字以内で書いてください。"
 
 # --- APIエンドポイントのルート定義 ---
 
-# 履歴データを全件取得するAPI
+HISTORY_STREAM_CHUNK = 100 # NDJSONで返す際に、Redisから一度に読み出す件数
+
+# 履歴データを取得するAPI
+# - クエリなし: 全件をJSON配列で返す
+# - ?offset=&limit=: 指定した範囲だけをJSON配列で返す
+# - ?format=ndjson: 1行1件(NDJSON)で逐次送信し、全件分の本文をメモリ上に作らない
 @app.route('/api/history', methods=['GET'])
-def get_history():
+async def get_history():
     app.logger.info("API '/api/history' called.")
-    return jsonify(history_log)
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({"error": "offset と limit には整数を指定してください。"}), 400
+    if offset < 0 or (limit is not None and limit < 0):
+        return jsonify({"error": "offset と limit には0以上の整数を指定してください。"}), 400
+    stop = None if limit is None else offset + limit
+
+    if request.args.get('format') == 'ndjson':
+        return Response(history_ndjson(offset, stop), mimetype="application/x-ndjson")
+
+    if redis_client:
+        # Redisには各履歴がJSON文字列で保存されているので、再エンコードせずに連結して返す
+        # LRANGE の終了位置 -1 は末尾を意味するので、limit=0 の場合は問い合わせない
+        items = [] if stop == offset else await redis_client.lrange(HISTORY_KEY, offset, -1 if stop is None else stop - 1)
+        return Response(b"[" + b",".join(items) + b"]", mimetype="application/json")
+    return jsonify(list(islice(history_log, offset, stop)))
+
+async def history_ndjson(offset, stop):
+    """指定範囲の履歴を、1件ずつNDJSONの行として返す"""
+    if redis_client:
+        # 一定件数ずつ読み出し、全件を一度にメモリに載せない
+        start = offset
+        while stop is None or start < stop:
+            end = start + HISTORY_STREAM_CHUNK - 1
+            if stop is not None:
+                end = min(end, stop - 1)
+            items = await redis_client.lrange(HISTORY_KEY, start, end)
+            if not items:
+                return
+            yield b"".join(item + b"\n" for item in items)
+            start += len(items)
+        return
+    # 送信中に履歴が追加・削除されても影響を受けないよう、参照だけを先に取り出しておく
+    for item in list(islice(history_log, offset, stop)):
+        yield orjson.dumps(item) + b"\n"
 
 # URL:/api/history/toggle_favorite/<item_id> でお気に入り状態を切り替える
 @app.route('/api/history/toggle_favorite/<item_id>', methods=['POST'])
-def toggle_favorite(item_id):
+async def toggle_favorite(item_id):
     app.logger.info(f"API '/api/history/toggle_favorite/{item_id}' called.")
     item_found = False
-    for item in history_log:
-        if item.get('id') == item_id:
+    if redis_client:
+        item_found = bool(await toggle_favorite_script(keys=[HISTORY_KEY], args=[item_id]))
+    else:
+        item = history_by_id.get(item_id)
+        if item is not None:
             item['favorite'] = not item.get('favorite', False)
             item_found = True
-            save_history(history_log) # 変更をファイルに保存
-            break
+            schedule_history_write() # 変更をファイルに保存
     if item_found:
         app.logger.info(f"Toggled favorite for item_id: {item_id}")
         return jsonify({"message": "Favorite status toggled successfully."})
@@ -189,106 +857,206 @@ def toggle_favorite(item_id):
 
 # 全ての履歴を削除するAPI
 @app.route('/api/history/clear', methods=['POST'])
-def clear_history():
+async def clear_history():
     app.logger.info("API '/api/history/clear' called.")
     global history_log
-    history_log.clear() # メモリ上のリストをクリア
-    save_history(history_log) # 空のリストをファイルに保存
+    if redis_client:
+        await redis_client.delete(HISTORY_KEY)
+    else:
+        history_log.clear() # メモリ上のリストをクリア
+        history_by_id.clear()
+        schedule_history_write() # 空の履歴をファイルに保存
     app.logger.info("History cleared successfully.")
     return jsonify({"message": "History cleared successfully."})
 
-# 物語のプロットを生成するAPI
-@app.route('/send_api', methods=['POST'])
-@api_endpoint
-def send_api(data):
-    app.logger.info("API '/send_api' called.")
-    received_text = data['text'].strip()
-    # 入力がキーワード群か（長すぎる文章でないか）を簡易的にチェック
-    word_count = len(received_text.replace('、', ' ').split())
-    if word_count > 10: # 例えば10単語より多い場合はエラーとする
-        app.logger.error(f"Input text is too long for keywords. Word count: {word_count}")
-        return jsonify({"error": "キーワード( 『、』やスペースで区切ったもの)を10個以内で入力してください。"}), 400
-    
+# --- AI機能のエンドポイント定義 ---
+
+@dataclass(frozen=True)
+class EndpointSpec:
+    """AI機能ごとの入力制限とプロンプトの組み立て方"""
+    build_prompts: Callable # (入力テキスト, リクエストデータ) -> (システムプロンプト, ユーザープロンプト, 履歴用テキスト)
+    model: str # 使用するモデル(MODELSの値)
+    max_words: Optional[int] = None # キーワード数の上限
+    word_pattern: re.Pattern = _WORD_RE # キーワードの区切り方
+    words_error: str = ""
+    max_chars: Optional[int] = None # 文字数の上限
+    chars_error: str = ""
+    # 意味的キャッシュを使うか。システムプロンプトに入力そのものを埋め込む機能では
+    # 入力ごとに名前空間が分かれ、完全一致キャッシュ以上のヒットが見込めないため False にする
+    semantic_cache: bool = True
+
+def plot_prompts(received_text, data):
     # フロントエンドから渡されたcontextをsystemプロンプトとして使用
     system_prompt = data.get('context', '').strip()
-    result = call_openrouter_api(system_prompt, received_text, received_text)
-    app.logger.info("API '/send_api' finished.")
+    return system_prompt, received_text, received_text
+
+def japanese_name_prompts(received_text, data):
+    system_prompt = _JP_NAME_PRE + received_text + _JP_NAME_POST
+    user_prompt = f"「{received_text}」を含む日本人名を提案してください。"
+    history_user_text = f"「{received_text}」を含む日本人名"
+    return system_prompt, user_prompt, history_user_text
+
+def foreign_name_prompts(received_text, data):
+    system_prompt = _FOREIGN_NAME_PRE + received_text + _FOREIGN_NAME_POST
+    user_prompt = f"「{received_text}」のイメージに合う外国人名を提案してください。"
+    history_user_text = f"「{received_text}」のイメージに合う外国人名"
+    return system_prompt, user_prompt, history_user_text
+
+def proofread_prompts(received_text, data):
+    history_user_text = f"【描写の元文章】\n{received_text}" # 履歴のフォーマットを維持
+    return _PROOFREAD_PROMPT, received_text, history_user_text
+
+def thesaurus_prompts(received_text, data):
+    system_prompt = _THESAURUS_PRE + received_text + _THESAURUS_POST
+    user_prompt = f"「{received_text}」の類語を解説付きで教えてください。"
+    history_user_text = f"「{received_text}」の類語検索"
+    return system_prompt, user_prompt, history_user_text
+
+ENDPOINTS = {
+    # 物語のプロット生成(入力がキーワード群か、長すぎる文章でないかを簡易的にチェック)
+    'plot': EndpointSpec(
+        build_prompts=plot_prompts,
+        model=MODELS['plot'],
+        max_words=10,
+        words_error="キーワード( 『、』やスペースで区切ったもの)を10個以内で入力してください。",
+    ),
+    # 日本人名の生成
+    'name_japanese': EndpointSpec(
+        build_prompts=japanese_name_prompts,
+        model=MODELS['name'],
+        max_words=3,
+        words_error="漢字( 『、』やスペースで区切ったもの)を3個以内で入力してください。",
+        semantic_cache=False,
+    ),
+    # 外国人名の生成
+    'name_foreign': EndpointSpec(
+        build_prompts=foreign_name_prompts,
+        model=MODELS['name'],
+        max_words=3,
+        words_error="キーワード( 『、』やスペースで区切ったもの)を3個以内で入力してください。",
+        semantic_cache=False,
+    ),
+    # 文章の描写の具体化
+    'proofread': EndpointSpec(
+        build_prompts=proofread_prompts,
+        model=MODELS['proofread'],
+        max_chars=100,
+        chars_error="入力できる文字数は100文字までです。",
+    ),
+    # 類語の検索(入力が1つのキーワードであるかチェック)
+    'thesaurus': EndpointSpec(
+        build_prompts=thesaurus_prompts,
+        model=MODELS['thesaurus'],
+        max_words=1,
+        word_pattern=_KEYWORD_RE,
+        words_error="キーワードを一つだけ入力してください。",
+        semantic_cache=False,
+    ),
+}
+
+def validate_input(spec, raw_text):
+    """
+    入力制限をチェックし、違反している場合はエラーレスポンスを返す(問題なければNone)。
+    strip() でコピーを作る前の、受信したままの文字列に対してチェックする。
+    """
+    # 受信したままの長さが上限以内なら、前後の空白を除いた長さも必ず上限以内
+    if spec.max_chars is not None and len(raw_text) > spec.max_chars:
+        text_length = len(raw_text.strip())
+        if text_length > spec.max_chars:
+            app.logger.error(f"Input text is too long: {text_length} characters.")
+            return jsonify({"error": spec.chars_error}), 400
+    if spec.max_words is not None:
+        # 区切り文字には空白が含まれるため、前後の空白の有無でキーワード数は変わらない
+        # 上限を超えたかどうかだけ分かればよいので、上限+1語まで数えたら打ち切る
+        if count_words(raw_text, spec.word_pattern, limit=spec.max_words) > spec.max_words:
+            app.logger.error(f"Input text is too long for keywords. Word count exceeds {spec.max_words}.")
+            return jsonify({"error": spec.words_error}), 400
+    return None
+
+async def handle_ai_request(name, data):
+    """AI機能のエンドポイントの共通処理(入力チェック、プロンプト組み立て、API呼び出し)"""
+    app.logger.info(f"API '{request.path}' called.")
+    spec = ENDPOINTS[name]
+    error_response = validate_input(spec, data['text'])
+    if error_response:
+        return error_response
+
+    received_text = data['text'].strip() # 入力制限のチェックを通った場合のみコピーする
+
+    system_prompt, user_prompt, history_user_text = spec.build_prompts(received_text, data)
+    result = await call_openrouter_api(system_prompt, user_prompt, history_user_text, stream=bool(data.get('stream')), model=spec.model, semantic=spec.semantic_cache)
+    app.logger.info(f"API '{request.path}' finished.")
     return result
 
+# 物語のプロットを生成するAPI
+@app.route('/send_api', methods=['POST'])
+@api_endpoint
+async def send_api(data):
+    return await handle_ai_request('plot', data)
+
 # 登場人物の名前を生成するAPI
 @app.route('/api/generate_name', methods=['POST'])
 @api_endpoint
-def generate_name_api(data):
-    app.logger.info("API '/api/generate_name' called.")
-    received_text = data['text'].strip()
+async def generate_name_api(data):
     mode = data.get('mode', 'japanese') # デフォルトは日本人名
-
-    if mode == 'japanese':
-        # 日本人名生成用のプロンプト設定
-        word_count = len(received_text.replace('、', ' ').split())
-        if word_count > 3: 
-            app.logger.error(f"Input text is too long for keywords. Word count: {word_count}")
-            return jsonify({"error": "漢字( 『、』やスペースで区切ったもの)を3個以内で入力してください。"}), 400
-        
-        system_prompt = f"あなたはプロの作家です。指定された漢字「{received_text}」をフルネームのどこかに含んだ、日本のキャラクター名を5つ提案してください。\n\n# 制約条件:\n- 提案は箇条書き（-）で記述してください。\n- それぞれの名前の横に、その名前が持つ雰囲気や由来を20字程度で簡潔に添えてください。"
-        history_user_text = f"「{received_text}」を含む日本人名"
-        user_prompt = f"「{received_text}」を含む日本人名を提案してください。"
-
-    elif mode == 'foreign':
-        # 外国人名生成用のプロンプト設定
-        word_count = len(received_text.replace('、', ' ').split())
-        if word_count > 3: 
-            app.logger.error(f"Input text is too long for keywords. Word count: {word_count}")
-            return jsonify({"error": "キーワード( 『、』やスペースで区切ったもの)を3個以内で入力してください。"}), 400
-        
-        system_prompt = f"あなたはプロの作家です。指定されたキーワード「{received_text}」のイメージに合う、外国風のキャラクター名をカタカナで5つ提案してください。フルネームでもファーストネームのみでも構いません。\n\n# 制約条件:\n- 提案は箇条書き（-）で記述してください。\n- それぞれの名前の横に、その名前が持つ雰囲気や由来を20字程度で簡潔に添えてください。"
-        history_user_text = f"「{received_text}」のイメージに合う外国人名"
-        user_prompt = f"「{received_text}」のイメージに合う外国人名を提案してください。"
-    else:
+    if mode not in ('japanese', 'foreign'):
         return jsonify({"error": "無効なモードが指定されました。"}), 400
+    return await handle_ai_request(f'name_{mode}', data)
 
-    result = call_openrouter_api(system_prompt, user_prompt, history_user_text)
-    app.logger.info("API '/api/generate_name' finished.")
-    return result
+# 日本人名と外国人名を同時に生成するAPI
+@app.route('/api/generate_name_pair', methods=['POST'])
+@api_endpoint
+async def generate_name_pair_api(data):
+    app.logger.info("API '/api/generate_name_pair' called.")
+    error_response = validate_input(ENDPOINTS['name_foreign'], data['text'])
+    if error_response:
+        return error_response
+
+    received_text = data['text'].strip() # 入力制限のチェックを通った場合のみコピーする
+
+    japanese_system, japanese_user, japanese_entry = japanese_name_prompts(received_text, data)
+    foreign_system, foreign_user, foreign_entry = foreign_name_prompts(received_text, data)
+    # 2つのAPI呼び出しを並行して実行し、待ち時間を1回分に抑える
+    # 片方が失敗したときに成功した側だけが履歴に残らないよう、両方の結果を待ってから履歴に追加する
+    results = await asyncio.gather(
+        complete_cached(japanese_system, japanese_user, model=MODELS['name'],
+                        semantic=ENDPOINTS['name_japanese'].semantic_cache),
+        complete_cached(foreign_system, foreign_user, model=MODELS['name'],
+                        semantic=ENDPOINTS['name_foreign'].semantic_cache),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            return ai_error_response(result)
+    (japanese_text, japanese_cached), (foreign_text, foreign_cached) = results
+
+    if japanese_text is None or foreign_text is None:
+        return jsonify({"error": "AIから有効な応答がありませんでした。"}), 500
+    await add_history(japanese_entry, japanese_text, cached=japanese_cached)
+    await add_history(foreign_entry, foreign_text, cached=foreign_cached)
+    app.logger.info("API '/api/generate_name_pair' finished.")
+    return jsonify({"message": "Success", "japanese": japanese_text, "foreign": foreign_text})
 
 # 文章の描写を具体化するAPI
 @app.route('/api/proofread', methods=['POST'])
 @api_endpoint
-def proofread_api(data):
-    app.logger.info("API '/api/proofread' called.")
-    received_text = data['text'].strip()
-    # 文字数制限をチェック
-    if len(received_text) > 100:
-        app.logger.error(f"Input text for proofreading is too long: {len(received_text)} characters.")
-        return jsonify({"error": "入力できる文字数は100文字までです。"}), 400
-
-    system_prompt = "あなたはプロの小説家です。以下のユーザーが入力した短い文章を、情景が目に浮かぶような、豊かで具体的な小説の描写に書き換えてください。\n\n# 指示:\n- 変換後の文章のみを出力し、解説や前置きは一切含めないでください。\n- 300字以内で書いてください。"
-    history_user_text = f"【描写の元文章】\n{received_text}" # 履歴のフォーマットを維持
-    result = call_openrouter_api(system_prompt, received_text, history_user_text)
-    app.logger.info("API '/api/proofread' finished.")
-    return result
+async def proofread_api(data):
+    return await handle_ai_request('proofread', data)
 
 # 類語を検索するAPI
 @app.route('/api/thesaurus', methods=['POST'])
 @api_endpoint
-def thesaurus_api(data):
-    app.logger.info("API '/api/thesaurus' called.")
-    received_text = data['text'].strip()
-    # 入力が1つのキーワードであるかチェック
-    word_count = len(received_text.replace('、', ' ').replace(',', ' ').split())
-    if word_count > 1:
-        return jsonify({"error": "キーワードを一つだけ入力してください。"}), 400
-
-    system_prompt = f"あなたは語彙の専門家です。ユーザーから提供されたキーワード「{received_text}」について、類語や言い換え表現を3つ提案し、それぞれの違いが明確にわかるように解説してください。\n\n# 出力形式:\n- 提案する語彙ごとに見出しを付けてください。\n- それぞれの語彙について、「ニュアンス」と「使用例」を具体的に説明してください。\n- 全体を300字程度にまとめてください。\n- 類語や言い換え表現は日本語で提案してください。"
-    user_prompt = f"「{received_text}」の類語を解説付きで教えてください。"
-    history_user_text = f"「{received_text}」の類語検索"
-    result = call_openrouter_api(system_prompt, user_prompt, history_user_text)
-    app.logger.info("API '/api/thesaurus' finished.")
-    return result
+async def thesaurus_api(data):
+    return await handle_ai_request('thesaurus', data)
 
 
-# スクリプトが直接実行された場合にのみ開発サーバーを起動
+# スクリプトが直接実行された場合にのみ開発サーバーを起動(開発専用)
+# 本番環境では start.sh (hypercorn -k uvloop app:app) でASGIサーバーを使って起動する
 if __name__ == '__main__':
     if not OPENROUTER_API_KEY:
         print("警告: 環境変数 OPENROUTER_API_KEY が設定されていません。API呼び出しは失敗します。")
+    # app.run(debug=True) ではインポート時点の app.debug はまだFalseなので、ここで無効にする
+    disable_static_cache()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
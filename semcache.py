@@ -0,0 +1,91 @@
+"""
+意味的キャッシュ(セマンティックキャッシュ)モジュール。
+
+過去の問い合わせとユーザー入力の埋め込みベクトルが十分に似ている場合に、
+OpenRouter APIを呼び出さずに以前のAI応答を再利用する。
+faiss と sentence-transformers がインストールされている場合のみ利用できる。
+これらのライブラリ(と依存するtorch)は読み込みが重いため、SemanticCache を作成した時点で初めて読み込む。
+"""
+import asyncio
+from collections import OrderedDict
+from itertools import count
+
+faiss = None
+np = None
+SentenceTransformer = None
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def _load_dependencies():
+    """faiss と sentence-transformers を読み込む。利用できない場合は RuntimeError を送出する"""
+    global faiss, np, SentenceTransformer
+    if faiss is not None:
+        return
+    try:
+        import faiss as _faiss
+        import numpy as _np
+        from sentence_transformers import SentenceTransformer as _SentenceTransformer
+    except Exception as e:
+        # 未インストールの場合だけでなく、torch等の読み込み自体が失敗した場合も同じ扱いにする
+        raise RuntimeError(f"faiss and sentence-transformers are required for SemanticCache: {e}") from e
+    faiss, np, SentenceTransformer = _faiss, _np, _SentenceTransformer
+
+
+class SemanticCache:
+    """
+    埋め込みの内積(L2正規化済みなのでコサイン類似度)でAI応答を検索するキャッシュ。
+
+    システムプロンプトとモデルの組(namespace)ごとにFAISSインデックスを分け、
+    ユーザー入力の類似度だけで判定する。プロンプトのテンプレート部分は共通で長いため、
+    全体を埋め込むと別のキーワード同士でも類似度が高くなってしまうのを防ぐ。
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL, threshold=0.95, max_entries=1024):
+        _load_dependencies()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # 埋め込みモデルは起動時に一度だけ読み込む
+        self._model = SentenceTransformer(model_name)
+        self._dim = self._model.get_sentence_embedding_dimension()
+        self._indexes = {} # namespace -> faiss.IndexIDMap2
+        self._entries = OrderedDict() # id -> (namespace, 応答テキスト)。LRU順に並ぶ
+        self._ids = count()
+
+    def _embed(self, text):
+        vec = self._model.encode([text], normalize_embeddings=True)
+        return np.asarray(vec, dtype='float32')
+
+    async def lookup(self, namespace, text):
+        """
+        類似した過去の応答を検索する。
+        (埋め込みベクトル, 応答テキスト or None) を返す。ベクトルはミス時の store() に渡す。
+        """
+        # 埋め込み計算はCPU処理なので、イベントループを止めないようスレッドで実行する
+        vec = await asyncio.to_thread(self._embed, text)
+        index = self._indexes.get(namespace)
+        if index is None or index.ntotal == 0:
+            return vec, None
+
+        scores, ids = index.search(vec, 1)
+        entry_id = int(ids[0][0])
+        if entry_id == -1 or scores[0][0] < self.threshold:
+            return vec, None
+        self._entries.move_to_end(entry_id)
+        return vec, self._entries[entry_id][1]
+
+    def store(self, namespace, vec, completion):
+        """AI応答をキャッシュに追加し、上限を超えた場合は最も古い応答を削除する"""
+        index = self._indexes.get(namespace)
+        if index is None:
+            index = self._indexes[namespace] = faiss.IndexIDMap2(faiss.IndexFlatIP(self._dim))
+        entry_id = next(self._ids)
+        index.add_with_ids(vec, np.array([entry_id], dtype='int64'))
+        self._entries[entry_id] = (namespace, completion)
+
+        while len(self._entries) > self.max_entries:
+            old_id, (old_namespace, _) = self._entries.popitem(last=False)
+            old_index = self._indexes[old_namespace]
+            old_index.remove_ids(np.array([old_id], dtype='int64'))
+            if old_index.ntotal == 0:
+                del self._indexes[old_namespace]
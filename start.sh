@@ -0,0 +1,21 @@
+#!/bin/sh
+# 本番用の起動スクリプト(Linux/macOS)
+# python app.py で起動する開発サーバーの代わりに、ASGIサーバー hypercorn + uvloop で起動する。
+#
+# 履歴をファイル(history.jsonl)に保存する場合、複数ワーカーで起動すると各ワーカーが
+# 別々に履歴を上書きしてしまうため、ワーカー数は REDIS_URL が設定されている場合のみ増やす。
+if [ -n "$REDIS_URL" ]; then
+    DEFAULT_WORKERS=$(nproc)
+else
+    DEFAULT_WORKERS=1
+fi
+
+# BACKLOG はOSの接続待ちキュー(accept される前の接続)の長さで、同時に処理する接続数の上限ではない。
+# 短時間に接続が集中しても拒否されないよう、大きめに取る。
+# 終了時(SIGTERM)は処理中のAI呼び出しが終わるまで GRACEFUL_TIMEOUT 秒待ち、その後履歴を書き出す。
+exec hypercorn -k uvloop \
+    --workers "${WORKERS:-$DEFAULT_WORKERS}" \
+    --bind "0.0.0.0:${PORT:-5000}" \
+    --backlog "${BACKLOG:-1000}" \
+    --graceful-timeout "${GRACEFUL_TIMEOUT:-60}" \
+    app:app